@@ -1,25 +1,115 @@
 import asyncio
-from typing import Optional, Dict, Any
+import io
+from typing import Optional, Dict, Any, Set, Callable
 from contextlib import AsyncExitStack
 import os
 import json
 import re
+import threading
+import time
+from collections import OrderedDict
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-from anthropic import Anthropic
-import dashscope
-from dashscope import Generation
 from dotenv import load_dotenv
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _canonical_json(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    _json_loads = json.loads
+
+    def _canonical_json(obj) -> bytes:
+        return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()
+
 load_dotenv()  # load environment variables from .env
 
+# Matches a line of the form: TOOL_CALL: tool_name {"param": "value"}
+# Surrounding whitespace may include \r from CRLF output or full-width spaces
+_TOOL_CALL_RE = re.compile(r'^[^\S\n]*TOOL_CALL:[^\S\n]*([^\s{]+)[^\S\n]*(\{.*\})?[^\S\n]*$', re.MULTILINE)
+
+# Static parts of the Qwen tool prompt, appended after the tool list
+_TOOL_CALL_USAGE = (
+    "\n\nTo use a tool, respond with: TOOL_CALL: tool_name {\"param1\": \"value1\", \"param2\": \"value2\"}"
+)
+_CITY_COORDS_HINT = (
+    "\n\nNote: Common city coordinates for weather queries:"
+    "\n- Sacramento: latitude=38.5816, longitude=-121.4944"
+    "\n- San Francisco: latitude=37.7749, longitude=-122.4194"
+    "\n- Los Angeles: latitude=34.0522, longitude=-118.2437"
+    "\n- New York: latitude=40.7128, longitude=-74.0060"
+    "\n- Beijing: latitude=39.9042, longitude=116.4074"
+    "\nFor other cities, use approximate coordinates or ask the user to provide them."
+)
+
+# Interpreter used to launch a server script, by file extension
+_SCRIPT_COMMANDS = {".py": "python", ".js": "node", ".mjs": "node", ".ts": "node"}
+
+# Tools whose name starts with one of these prefixes are treated as read-only
+# and their results are cached, unless an explicit set is passed to MCPClient
+_CACHEABLE_TOOL_PREFIXES = ("get_", "list_")
+_TOOL_CACHE_MAXSIZE = 512
+_TOOL_CACHE_TTL = 300  # seconds
+
+# Converts a message to Qwen format by role. Qwen has no tool role, so tool
+# results become user messages; other messages are already in the right shape
+# and are shared as-is.
+_QWEN_ROLE_TRANSLATORS = {
+    "tool": lambda msg: {"role": "user", "content": f"Tool result: {msg['content']}"},
+    "user": lambda msg: msg,
+    "assistant": lambda msg: msg,
+    "system": lambda msg: msg,
+}
+
+class _QwenHistory:
+    """Qwen-format copy of one conversation, extended incrementally"""
+    def __init__(self):
+        self.messages: list = []
+        self.synced = 0  # number of source messages already converted
+
+async def _ainput(prompt: str) -> str:
+    """Read a line of input without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def read():
+        try:
+            line = input(prompt)
+        except Exception as e:
+            loop.call_soon_threadsafe(deliver, None, e)
+        else:
+            loop.call_soon_threadsafe(deliver, line, None)
+
+    # A daemon thread rather than asyncio.to_thread: interpreter shutdown joins
+    # executor threads, so Ctrl-C would wait for input() to return
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
 class MCPClient:
-    def __init__(self, model_config: Optional[Dict[str, Any]] = None):
+    def __init__(self, model_config: Optional[Dict[str, Any]] = None, cacheable_tools: Optional[Set[str]] = None):
         # Initialize session and client objects
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
+        self._server_params: Optional[StdioServerParameters] = None
+        self._connected = False
+        self._available_tools: list = []
+        self._qwen_tools_prompt: Optional[str] = None
+        
+        # Results of read-only tool calls: (name, canonical args) -> (expiry, result)
+        self._cacheable_tools = cacheable_tools
+        self._tool_cache: OrderedDict = OrderedDict()
         
         # Model configuration
         self.model_config = model_config or {
@@ -30,6 +120,10 @@ class MCPClient:
         
         # Initialize the appropriate client based on provider
         self._init_model_client()
+        
+        # Bound the number of concurrent requests to the model provider, so
+        # queries processed in parallel share one session without hitting rate limits
+        self._model_semaphore = asyncio.Semaphore(self.model_config.get("max_concurrency", 8))
 
     def _init_model_client(self):
         """Initialize the model client based on the provider configuration"""
@@ -39,7 +133,9 @@ class MCPClient:
             api_key = self.model_config.get("api_key") or os.getenv("ANTHROPIC_API_KEY")
             if not api_key:
                 raise ValueError("Anthropic API key is required")
-            self.anthropic = Anthropic(api_key=api_key)
+            # Provider SDKs are imported lazily so only the selected one is loaded
+            from anthropic import AsyncAnthropic
+            self.anthropic = AsyncAnthropic(api_key=api_key)
             self.client_type = "anthropic"
             
         elif provider == "qwen" or provider == "dashscope":
@@ -47,14 +143,39 @@ class MCPClient:
             if not api_key:
                 raise ValueError("DashScope API key is required for Qwen models")
             
+            import dashscope
+            from dashscope import Generation
             dashscope.api_key = api_key
+            self._Generation = Generation
             self.client_type = "qwen"
             
         else:
             raise ValueError(f"Unsupported provider: {provider}")
 
-    def _call_model(self, messages: list, tools: list = None):
-        """Call the configured model with messages and tools"""
+    def _build_qwen_tools_prompt(self, tools: list) -> str:
+        """Build the tool usage prompt prepended to Qwen conversations"""
+        tool_descriptions = []
+        for tool in tools:
+            tool_desc = f"- {tool['name']}: {tool['description']}"
+            props = tool.get('input_schema', {}).get('properties')
+            if props:
+                tool_desc += f" (parameters: {', '.join(props)})"
+            tool_descriptions.append(tool_desc)
+
+        tools_info = "Available tools:\n" + "\n".join(tool_descriptions) + _TOOL_CALL_USAGE + _CITY_COORDS_HINT
+        return tools_info
+
+    async def _call_model(self, messages: list, tools: list = None, qwen_history: Optional[_QwenHistory] = None,
+                          on_tool_use: Optional[Callable[[Any], None]] = None):
+        """Call the configured model with messages and tools
+        
+        For Qwen, pass the same qwen_history on every call of a conversation
+        so that only newly added messages are converted.
+        
+        For Anthropic, the response is streamed and on_tool_use, if given, is
+        called with each tool_use block as soon as it is complete, before the
+        rest of the response has been generated.
+        """
         model_name = self.model_config.get("model")
         max_tokens = self.model_config.get("max_tokens", 1000)
         
@@ -66,190 +187,292 @@ class MCPClient:
             }
             if tools:
                 kwargs["tools"] = tools
-            return self.anthropic.messages.create(**kwargs)
+            async with self._model_semaphore:
+                async with self.anthropic.messages.stream(**kwargs) as stream:
+                    async for event in stream:
+                        if (on_tool_use is not None and event.type == "content_block_stop"
+                                and event.content_block.type == "tool_use"):
+                            on_tool_use(event.content_block)
+                    return await stream.get_final_message()
             
         elif self.client_type == "qwen":
-            # Convert messages to Qwen format
-            qwen_messages = []
-            for msg in messages:
-                if msg["role"] == "tool":
-                    # Convert tool results to user messages for Qwen
-                    qwen_messages.append({
-                        "role": "user",
-                        "content": f"Tool result: {msg['content']}"
-                    })
-                else:
-                    qwen_messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
+            # Only convert the messages added since the previous call; the
+            # already-converted prefix is kept in qwen_history
+            if qwen_history is None:
+                qwen_history = _QwenHistory()
+            is_first_call = qwen_history.synced == 0
+            qwen_history.messages.extend(
+                _QWEN_ROLE_TRANSLATORS[msg["role"]](msg) for msg in messages[qwen_history.synced:]
+            )
+            qwen_history.synced = len(messages)
+            qwen_messages = qwen_history.messages
             
-            # Add tool information to the system message if tools are available
-            if tools:
-                tool_descriptions = []
-                for tool in tools:
-                    tool_desc = f"- {tool['name']}: {tool['description']}"
-                    if tool.get('input_schema', {}).get('properties'):
-                        params = list(tool['input_schema']['properties'].keys())
-                        tool_desc += f" (parameters: {', '.join(params)})"
-                    tool_descriptions.append(tool_desc)
+            # Add tool information to the first user message if tools are available
+            if tools and is_first_call:
+                if self._qwen_tools_prompt is None:
+                    self._qwen_tools_prompt = self._build_qwen_tools_prompt(tools)
+                tools_info = self._qwen_tools_prompt
                 
-                tools_info = "Available tools:\n" + "\n".join(tool_descriptions)
-                tools_info += "\n\nTo use a tool, respond with: TOOL_CALL: tool_name {\"param1\": \"value1\", \"param2\": \"value2\"}"
-                tools_info += "\n\nNote: Common city coordinates for weather queries:"
-                tools_info += "\n- Sacramento: latitude=38.5816, longitude=-121.4944"
-                tools_info += "\n- San Francisco: latitude=37.7749, longitude=-122.4194"
-                tools_info += "\n- Los Angeles: latitude=34.0522, longitude=-118.2437"
-                tools_info += "\n- New York: latitude=40.7128, longitude=-74.0060"
-                tools_info += "\n- Beijing: latitude=39.9042, longitude=116.4074"
-                tools_info += "\nFor other cities, use approximate coordinates or ask the user to provide them."
-                
-                # Add tools info to the first user message
                 if qwen_messages and qwen_messages[0]["role"] == "user":
-                    qwen_messages[0]["content"] = tools_info + "\n\n" + qwen_messages[0]["content"]
+                    # Replace rather than mutate: the entry may be shared with `messages`
+                    qwen_messages[0] = {
+                        "role": "user",
+                        "content": tools_info + "\n\n" + qwen_messages[0]["content"]
+                    }
                 else:
                     qwen_messages.insert(0, {"role": "user", "content": tools_info})
             
-            response = Generation.call(
-                model=model_name,
-                messages=qwen_messages,
-                max_tokens=max_tokens,
-                result_format='message'
-            )
+            # DashScope has no async client; run the blocking call in a worker thread
+            async with self._model_semaphore:
+                response = await asyncio.to_thread(
+                    self._Generation.call,
+                    model=model_name,
+                    messages=qwen_messages,
+                    max_tokens=max_tokens,
+                    result_format='message'
+                )
             return response
 
+    def _is_cacheable_tool(self, tool_name: str) -> bool:
+        """Whether results of the given tool may be served from the cache"""
+        if self._cacheable_tools is not None:
+            return tool_name in self._cacheable_tools
+        return tool_name.startswith(_CACHEABLE_TOOL_PREFIXES)
+
+    async def _call_tool_cached(self, tool_name: str, tool_args: Dict[str, Any]):
+        """Call a tool, reusing a recent result for identical read-only calls"""
+        if not self._is_cacheable_tool(tool_name):
+            return await self.session.call_tool(tool_name, tool_args)
+        
+        key = (tool_name, _canonical_json(tool_args))
+        now = time.monotonic()
+        cached = self._tool_cache.get(key)
+        if cached is not None:
+            expires_at, result = cached
+            if expires_at > now:
+                self._tool_cache.move_to_end(key)
+                return result
+            del self._tool_cache[key]
+        
+        result = await self.session.call_tool(tool_name, tool_args)
+        if not result.isError:
+            self._tool_cache[key] = (now + _TOOL_CACHE_TTL, result)
+            if len(self._tool_cache) > _TOOL_CACHE_MAXSIZE:
+                self._tool_cache.popitem(last=False)
+        return result
+
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
         
         Args:
-            server_script_path: Path to the server script (.py or .js)
+            server_script_path: Path to the server script (.py, .js, .mjs or .ts)
         """
-        is_python = server_script_path.endswith('.py')
-        is_js = server_script_path.endswith('.js')
-        if not (is_python or is_js):
-            raise ValueError("Server script must be a .py or .js file")
+        command = _SCRIPT_COMMANDS.get(os.path.splitext(server_script_path)[1])
+        if command is None:
+            raise ValueError(f"Server script must be one of: {', '.join(_SCRIPT_COMMANDS)}")
             
-        command = "python" if is_python else "node"
-        server_params = StdioServerParameters(
+        self._server_params = StdioServerParameters(
             command=command,
-            args=[server_script_path],
-            env=None
+            args=[server_script_path]
         )
         
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
+        await self.connect()
+
+    async def connect(self):
+        """Start the server process and open a session, unless already connected
+        
+        The session is kept open until disconnect() so that every query
+        reuses the same server process.
+        """
+        if self._connected:
+            return
+        if self._server_params is None:
+            raise ValueError("No server configured, call connect_to_server() first")
+        
+        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(self._server_params))
         self.stdio, self.write = stdio_transport
         self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
         
         await self.session.initialize()
         
         # List available tools
+        await self.refresh_tools()
+        self._connected = True
+        print("\nConnected to server with tools:", [tool["name"] for tool in self._available_tools])
+
+    async def disconnect(self):
+        """Close the session and stop the server process; connect() can be called again"""
+        await self.exit_stack.aclose()
+        self.exit_stack = AsyncExitStack()
+        self.session = None
+        self._connected = False
+        self._tool_cache.clear()
+
+    async def refresh_tools(self):
+        """Re-fetch the tool list from the server and update the cached copy"""
         response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        self._available_tools = [{
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        } for tool in response.tools]
+        
+        # The Qwen tool prompt only depends on the tool list, so build it here once
+        self._qwen_tools_prompt = None
+        if self.client_type == "qwen":
+            self._qwen_tools_prompt = self._build_qwen_tools_prompt(self._available_tools)
 
     async def process_query(self, query: str) -> str:
         """Process a query using the configured model and available tools"""
+        if not self._connected:
+            raise RuntimeError("Not connected to a server, call connect() first")
+        
         messages = [
             {
                 "role": "user",
                 "content": query
             }
         ]
+        qwen_history = _QwenHistory()
 
-        response = await self.session.list_tools()
-        available_tools = [{ 
-            "name": tool.name,
-            "description": tool.description,
-            "input_schema": tool.inputSchema
-        } for tool in response.tools]
+        available_tools = self._available_tools
+
+        # Tool calls are started while the response is still streaming
+        tool_tasks: Dict[str, asyncio.Task] = {}
+        def start_tool_call(block):
+            tool_tasks[block.id] = asyncio.create_task(self._call_tool_cached(block.name, block.input))
 
         # Initial API call using the configured client
-        response = self._call_model(messages, available_tools)
+        try:
+            response = await self._call_model(messages, available_tools, qwen_history, on_tool_use=start_tool_call)
+        except BaseException:
+            # Don't leave tool calls running for a response that never completed
+            for task in tool_tasks.values():
+                task.cancel()
+            raise
+
+        # Fast path: a plain text answer needs no tool handling
+        if self.client_type == "anthropic":
+            if len(response.content) == 1 and response.content[0].type == 'text':
+                return response.content[0].text
+        elif response.status_code == 200:
+            message_content = response.output.choices[0].message.content
+            if "TOOL_CALL:" not in message_content:
+                return message_content
 
         # Process response and handle tool calls
         tool_results = []
-        final_text = []
+        final_text = io.StringIO()
 
         if self.client_type == "anthropic":
+            tool_uses = []
             for content in response.content:
                 if content.type == 'text':
-                    final_text.append(content.text)
+                    print(content.text, file=final_text)
                 elif content.type == 'tool_use':
-                    tool_name = content.name
-                    tool_args = content.input
-                    
-                    # Execute tool call
-                    result = await self.session.call_tool(tool_name, tool_args)
-                    tool_results.append({"call": tool_name, "result": result})
-                    final_text.append(f"[Calling tool {tool_name} with args {tool_args}]")
+                    tool_uses.append(content)
+                    print(f"[Calling tool {content.name} with args {content.input}]", file=final_text)
 
-                    # Continue conversation with tool results
-                    if hasattr(content, 'text') and content.text:
-                        messages.append({
-                          "role": "assistant",
-                          "content": content.text
+            if tool_uses:
+                # Wait for the tool calls started during streaming
+                for content in tool_uses:
+                    if content.id not in tool_tasks:
+                        start_tool_call(content)
+                results = await asyncio.gather(
+                    *(tool_tasks[content.id] for content in tool_uses),
+                    return_exceptions=True
+                )
+
+                # Continue conversation with all tool results in a single turn
+                messages.append({
+                    "role": "assistant",
+                    "content": response.content
+                })
+                tool_result_blocks = []
+                for content, result in zip(tool_uses, results):
+                    if isinstance(result, Exception):
+                        print(f"Tool call failed: {result}", file=final_text)
+                        tool_result_blocks.append({
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": f"Tool call failed: {result}",
+                            "is_error": True
                         })
-                    messages.append({
-                        "role": "user", 
-                        "content": result.content
+                        continue
+                    tool_results.append({"call": content.name, "result": result})
+                    tool_result_blocks.append({
+                        "type": "tool_result",
+                        "tool_use_id": content.id,
+                        "content": [{"type": "text", "text": item.text} for item in result.content if item.type == "text"]
                     })
+                messages.append({
+                    "role": "user",
+                    "content": tool_result_blocks
+                })
 
-                    # Get next response
-                    response = self._call_model(messages, available_tools)
-                    final_text.append(response.content[0].text)
+                # Get next response
+                response = await self._call_model(messages, available_tools, qwen_history)
+                for content in response.content:
+                    if content.type == 'text':
+                        print(content.text, file=final_text)
                     
         elif self.client_type == "qwen":
             if response.status_code == 200:
                 message_content = response.output.choices[0].message.content
                 
-                # Check if the response contains a tool call
-                if "TOOL_CALL:" in message_content:
-                    lines = message_content.split('\n')
-                    for line in lines:
-                        if line.strip().startswith("TOOL_CALL:"):
-                            try:
-                                # Parse tool call: TOOL_CALL: tool_name {"param": "value"}
-                                parts = line.strip().split("TOOL_CALL:", 1)[1].strip().split(" ", 1)
-                                tool_name = parts[0].strip()
-                                tool_args = {}
-                                
-                                if len(parts) > 1:
-                                    tool_args = json.loads(parts[1].strip())
-                                
-                                # Execute tool call
-                                result = await self.session.call_tool(tool_name, tool_args)
-                                tool_results.append({"call": tool_name, "result": result})
-                                final_text.append(f"[Calling tool {tool_name} with args {tool_args}]")
-                                
-                                # Continue conversation with tool results
-                                messages.append({
-                                    "role": "assistant",
-                                    "content": message_content
-                                })
-                                messages.append({
-                                    "role": "user",
-                                    "content": f"Tool result: {result.content}"
-                                })
-                                
-                                # Get next response
-                                response = self._call_model(messages, available_tools)
-                                if response.status_code == 200:
-                                    final_text.append(response.output.choices[0].message.content)
-                                
-                            except Exception as e:
-                                final_text.append(f"Error parsing tool call: {e}")
-                                final_text.append(message_content)
-                            break
-                    else:
-                        # No tool call found, just add the message
-                        final_text.append(message_content)
+                # Check if the response contains tool calls
+                matches = list(_TOOL_CALL_RE.finditer(message_content))
+                if matches:
+                    try:
+                        # Parse tool calls: TOOL_CALL: tool_name {"param": "value"}
+                        tool_calls = []
+                        for match in matches:
+                            tool_args = _json_loads(match.group(2)) if match.group(2) else {}
+                            tool_calls.append((match.group(1), tool_args))
+                        
+                        # Execute the tool calls concurrently
+                        results = await asyncio.gather(*(
+                            self._call_tool_cached(tool_name, tool_args) for tool_name, tool_args in tool_calls
+                        ), return_exceptions=True)
+                        
+                        result_texts = []
+                        for (tool_name, tool_args), result in zip(tool_calls, results):
+                            if isinstance(result, Exception):
+                                print(f"Tool call failed: {result}", file=final_text)
+                                result_texts.append(f"Tool result [{tool_name}]: call failed: {result}")
+                                continue
+                            tool_results.append({"call": tool_name, "result": result})
+                            print(f"[Calling tool {tool_name} with args {tool_args}]", file=final_text)
+                            text = "\n".join(item.text for item in result.content if item.type == "text")
+                            result_texts.append(f"Tool result [{tool_name}]: {text}")
+                        
+                        # Continue conversation with all tool results in a single turn
+                        messages.append({
+                            "role": "assistant",
+                            "content": message_content
+                        })
+                        messages.append({
+                            "role": "user",
+                            "content": "\n\n".join(result_texts)
+                        })
+                        
+                        # Get next response
+                        response = await self._call_model(messages, available_tools, qwen_history)
+                        if response.status_code == 200:
+                            print(response.output.choices[0].message.content, file=final_text)
+                        
+                    except Exception as e:
+                        print(f"Error parsing tool call: {e}", file=final_text)
+                        print(message_content, file=final_text)
                 else:
-                    final_text.append(message_content)
+                    # No tool call found, just add the message
+                    print(message_content, file=final_text)
                 
             else:
-                final_text.append(f"Error: {response.message}")
+                print(f"Error: {response.message}", file=final_text)
 
-        return "\n".join(final_text)
+        # Drop the newline written after the last line
+        return final_text.getvalue()[:-1]
 
     async def chat_loop(self):
         """Run an interactive chat loop"""
@@ -258,7 +481,7 @@ class MCPClient:
         
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                query = (await _ainput("\nQuery: ")).strip()
                 
                 if query.lower() == 'quit':
                     break
@@ -266,12 +489,14 @@ class MCPClient:
                 response = await self.process_query(query)
                 print("\n" + response)
                     
+            except EOFError:
+                break
             except Exception as e:
                 print(f"\nError: {str(e)}")
     
     async def cleanup(self):
         """Clean up resources"""
-        await self.exit_stack.aclose()
+        await self.disconnect()
 
 async def main():
     import argparse
@@ -291,8 +516,8 @@ async def main():
     model_config = {}
     if args.config:
         try:
-            with open(args.config, 'r') as f:
-                model_config = json.load(f)
+            with open(args.config, 'rb') as f:
+                model_config = _json_loads(f.read())
         except Exception as e:
             print(f"Error loading config file: {e}")
             sys.exit(1)
@@ -0,0 +1,77 @@
+"""
+在同一个进程中托管多个FastMCP服务器
+
+由 MultiServerMCPClient 为配置了相同 group 的Python服务器启动，
+避免为每个小型服务器单独启动一个Python解释器。
+
+用法: python group_server.py <组名> <服务器名>=<脚本路径> [<服务器名>=<脚本路径> ...]
+
+每个服务器的工具以 "<服务器名>__<工具名>" 的名称注册，
+客户端据此把工具还原到各自的逻辑服务器。
+"""
+
+import importlib.util
+import os
+import sys
+from typing import Any, Dict
+
+import anyio
+from mcp.server.fastmcp import FastMCP
+from mcp.server.lowlevel import Server
+from mcp.server.stdio import stdio_server
+
+# 服务器名与工具名之间的分隔符，multi_server_client.py 从这里导入
+TOOL_NAME_SEPARATOR = "__"
+
+def load_server(server_name: str, script_path: str) -> FastMCP:
+    """导入服务器脚本并返回其中的FastMCP实例"""
+    # 允许脚本导入同目录下的模块
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script_path)))
+
+    spec = importlib.util.spec_from_file_location(f"_grouped_{server_name}", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    for value in vars(module).values():
+        if isinstance(value, FastMCP):
+            return value
+    raise ValueError(f"服务器脚本中没有FastMCP实例: {script_path}")
+
+async def serve(group_name: str, servers: Dict[str, FastMCP]):
+    """通过stdio提供组内所有服务器的工具，调用转发给各自的服务器"""
+    host = Server(group_name)
+
+    tools = []
+    for server_name, server in servers.items():
+        for tool in await server.list_tools():
+            tools.append(tool.model_copy(update={"name": f"{server_name}{TOOL_NAME_SEPARATOR}{tool.name}"}))
+
+    @host.list_tools()
+    async def list_tools():
+        return tools
+
+    @host.call_tool()
+    async def call_tool(name: str, arguments: Dict[str, Any]):
+        # 由原服务器执行，错误信息中显示的是模型看到的工具名
+        server_name, _, tool_name = name.partition(TOOL_NAME_SEPARATOR)
+        server = servers.get(server_name)
+        if server is None:
+            raise ValueError(f"未知的工具: {name}")
+        return await server.call_tool(tool_name, arguments)
+
+    async with stdio_server() as (read_stream, write_stream):
+        await host.run(read_stream, write_stream, host.create_initialization_options())
+
+def main():
+    """主函数"""
+    group_name, *entries = sys.argv[1:]
+
+    servers = {}
+    for entry in entries:
+        server_name, script_path = entry.split("=", 1)
+        servers[server_name] = load_server(server_name, script_path)
+
+    anyio.run(serve, group_name, servers)
+
+if __name__ == "__main__":
+    main()
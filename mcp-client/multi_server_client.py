@@ -1,21 +1,188 @@
 import asyncio
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+from collections import Counter
 from contextlib import AsyncExitStack
+import hashlib
 import os
 import json
 import re
+import threading
 from dataclasses import dataclass
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, CallToolResult, TextContent
 
-from anthropic import Anthropic
+import anyio
+import httpx
+import requests
+from anthropic import APIConnectionError, AsyncAnthropic
 import dashscope
 from dashscope import Generation
 from dotenv import load_dotenv
 
+from group_server import TOOL_NAME_SEPARATOR
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _canonical_json(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:  # orjson为可选依赖，未安装时使用标准库
+    _json_loads = json.loads
+
+    def _canonical_json(obj) -> bytes:
+        return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()
+
 load_dotenv()  # load environment variables from .env
 
+# 匹配形如 TOOL_CALL: tool_name {"param": "value"} 的行
+# 行首行尾的空白可能包含CRLF中的\r或全角空格
+_TOOL_CALL_RE = re.compile(r'^[^\S\n]*TOOL_CALL:[^\S\n]*([^\s{]+)[^\S\n]*(\{.*\})?[^\S\n]*$', re.MULTILINE)
+
+# 托管同组服务器的脚本
+_GROUP_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "group_server.py")
+
+# 可以重试的传输层错误：超时、无法连接或连接中断（各SDK的异常类型互不继承）
+_TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    httpx.TransportError,
+    APIConnectionError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+def _is_transient_error(error: BaseException) -> bool:
+    """判断错误是否为可以重试的传输层错误"""
+    if isinstance(error, McpError):
+        return error.error.code == CONNECTION_CLOSED
+    return isinstance(error, _TRANSIENT_ERRORS)
+
+def _result_text(result: CallToolResult) -> str:
+    """拼接工具结果中的文本内容"""
+    return "\n".join(item.text for item in result.content if item.type == "text")
+
+# 单次查询中相同工具及参数最多执行的次数，超过后视为循环调用并中止
+_MAX_TOOL_CALL_REPEATS = 2
+# 单次查询中默认最多进行的工具调用轮数，以及连续失败多少次后停止调用模型
+_MAX_TOOL_ROUNDS = 5
+_MAX_CONSECUTIVE_TOOL_ERRORS = 3
+
+# 客户端内置的批量调用工具，让模型在一次回复中并行执行多个相互独立的工具调用
+BATCH_EXECUTE_TOOL = "batch_execute"
+_BATCH_EXECUTE_TOOL_SPEC = {
+    "name": BATCH_EXECUTE_TOOL,
+    "description": "并行执行多个相互独立的工具调用，并一次性返回所有结果",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "calls": {
+                "type": "array",
+                "description": "要执行的工具调用列表",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "tool": {"type": "string", "description": "工具名称"},
+                        "args": {"type": "object", "description": "工具参数"}
+                    },
+                    "required": ["tool"]
+                }
+            },
+            "maxConcurrent": {"type": "integer", "description": "最大并发数，默认为8"},
+            "stopOnError": {"type": "boolean", "description": "任一调用失败时是否中止整个批次，默认为false"}
+        },
+        "required": ["calls"]
+    },
+    "server": "客户端内置"
+}
+
+async def _ainput(prompt: str) -> str:
+    """在不阻塞事件循环的情况下读取一行输入"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def read():
+        try:
+            line = input(prompt)
+        except Exception as e:
+            loop.call_soon_threadsafe(deliver, None, e)
+        else:
+            loop.call_soon_threadsafe(deliver, line, None)
+
+    # 使用守护线程而不是 asyncio.to_thread：退出时会等待线程池中的线程，
+    # 按下 Ctrl-C 后程序会卡在 input() 上直到用户按回车
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+class _ToolCallLineFilter:
+    """转发Qwen的流式输出，过滤掉 TOOL_CALL 指令行
+
+    只有可能成为 TOOL_CALL 行的行首会暂缓输出，其余文本收到后立即转发。
+    """
+    _MARKER = "TOOL_CALL:"
+
+    def __init__(self, on_text: Callable[[str], None]):
+        self.on_text = on_text
+        self.pending: List[str] = []  # 当前行中暂缓输出的片段
+        self.state: Optional[str] = None  # 当前行：None 尚未确定，"plain" 普通文本，"tool" 以 TOOL_CALL: 开头
+        self.line_open = False  # 已输出的内容是否停在一行中间
+
+    def _emit(self, text: str):
+        if text:
+            self.on_text(text)
+            self.line_open = not text.endswith("\n")
+
+    def _end_line(self):
+        line = "".join(self.pending)
+        if self.state != "tool" or not _TOOL_CALL_RE.match(line):
+            self._emit(line)
+        self.pending = []
+        self.state = None
+
+    def feed(self, text: str):
+        start = 0
+        while start < len(text):
+            newline = text.find("\n", start)
+            end = len(text) if newline < 0 else newline + 1
+            part = text[start:end]
+            start = end
+            
+            if self.state == "plain":
+                self._emit(part)
+            else:
+                self.pending.append(part)
+                if self.state is None:
+                    head = "".join(self.pending).lstrip()
+                    if head.startswith(self._MARKER):
+                        self.state = "tool"
+                    elif newline >= 0 or not self._MARKER.startswith(head):
+                        # 不可能是 TOOL_CALL 行，之后的内容直接转发
+                        self.state = "plain"
+                        self._emit("".join(self.pending))
+                        self.pending = []
+            if newline >= 0:
+                self._end_line()
+
+    def close(self):
+        """输出暂缓的最后一行，并以换行结束输出"""
+        self._end_line()
+        if self.line_open:
+            self.on_text("\n")
+            self.line_open = False
+
 @dataclass
 class ServerConfig:
     """MCP服务器配置"""
@@ -24,6 +191,7 @@ class ServerConfig:
     script_path: str
     enabled: bool = True
     config: Dict[str, Any] = None
+    group: Optional[str] = None  # 相同group的Python服务器共享一个进程
     
     def __post_init__(self):
         if self.config is None:
@@ -37,6 +205,7 @@ class ServerConnection:
     stdio: Any
     write: Any
     tools: List[Dict[str, Any]]
+    tool_prefix: str = ""  # 共享进程中工具名的前缀
 
 class MultiServerMCPClient:
     """支持多个MCP服务器的客户端"""
@@ -50,6 +219,19 @@ class MultiServerMCPClient:
         self.exit_stack = AsyncExitStack()
         self.servers: Dict[str, ServerConnection] = {}
         self.tool_server_map: Dict[str, str] = {}  # tool_name -> server_name
+        self._retryable_tools: set = set()  # 声明为只读或幂等、超时后可安全重试的工具
+        
+        # 工具列表及其序列化结果的缓存，在服务器集合变化时重建
+        self._all_tools_cached: List[Dict[str, Any]] = []
+        self._anthropic_tools_cached: List[Dict[str, Any]] = []
+        self._qwen_tools_prompt: Optional[str] = None
+        
+        # 按字段拆分的工具信息（与 _all_tools_cached 顺序一致），用于生成提示词
+        self._tool_names: List[str] = []
+        self._tool_descs: List[str] = []
+        self._tool_servers: List[str] = []
+        self._tool_schemas: List[Dict[str, Any]] = []
+        self._tool_param_names: List[tuple] = []
         
         # 加载配置
         self.config = self._load_config(config_path)
@@ -63,8 +245,8 @@ class MultiServerMCPClient:
     def _load_config(self, config_path: str) -> Dict[str, Any]:
         """加载配置文件"""
         try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(config_path, 'rb') as f:
+                return _json_loads(f.read())
         except Exception as e:
             raise ValueError(f"无法加载配置文件 {config_path}: {e}")
 
@@ -76,7 +258,7 @@ class MultiServerMCPClient:
             api_key = self.model_config.get("api_key") or os.getenv("ANTHROPIC_API_KEY")
             if not api_key:
                 raise ValueError("需要Anthropic API密钥")
-            self.anthropic = Anthropic(api_key=api_key)
+            self.anthropic = AsyncAnthropic(api_key=api_key)
             self.client_type = "anthropic"
             
         elif provider == "qwen" or provider == "dashscope":
@@ -92,24 +274,46 @@ class MultiServerMCPClient:
 
     async def connect_to_servers(self):
         """连接到所有启用的MCP服务器"""
-        connection_tasks = []
-        
+        # 每个单元对应一个服务器进程：独立服务器单独成组，同组的Python服务器合并
+        units: List[List[ServerConfig]] = []
+        groups: Dict[str, List[ServerConfig]] = {}
         for server_config in self.server_configs:
-            if server_config.enabled:
-                task = self._connect_to_server(server_config)
-                connection_tasks.append(task)
+            if not server_config.enabled:
+                continue
+            if server_config.group and server_config.script_path.endswith('.py'):
+                if server_config.group not in groups:
+                    groups[server_config.group] = []
+                    units.append(groups[server_config.group])
+                groups[server_config.group].append(server_config)
+            else:
+                units.append([server_config])
+        
+        # 限制同时启动的服务器进程数量
+        semaphore = asyncio.Semaphore(self.global_settings.get("concurrent_connections", 8))
+        
+        async def connect_limited(unit: List[ServerConfig]):
+            async with semaphore:
+                if len(unit) == 1:
+                    await self._connect_to_server(unit[0])
+                else:
+                    await self._connect_to_group(unit[0].group, unit)
         
         # 并发连接所有服务器
-        if connection_tasks:
-            results = await asyncio.gather(*connection_tasks, return_exceptions=True)
+        if units:
+            results = await asyncio.gather(
+                *(connect_limited(unit) for unit in units),
+                return_exceptions=True
+            )
             
             # 处理连接结果
-            for i, result in enumerate(results):
-                server_config = [s for s in self.server_configs if s.enabled][i]
-                if isinstance(result, Exception):
-                    print(f"连接服务器 {server_config.name} 失败: {result}")
-                else:
-                    print(f"成功连接到服务器: {server_config.name}")
+            for unit, result in zip(units, results):
+                for server_config in unit:
+                    if isinstance(result, Exception):
+                        print(f"连接服务器 {server_config.name} 失败: {result}")
+                    else:
+                        print(f"成功连接到服务器: {server_config.name}")
+        
+        self._refresh_tool_caches()
 
     async def _connect_to_server(self, server_config: ServerConfig):
         """连接到单个MCP服务器"""
@@ -131,25 +335,15 @@ class MultiServerMCPClient:
                 env=None
             )
             
-            # 建立连接
-            stdio_transport = await self.exit_stack.enter_async_context(
-                stdio_client(server_params)
-            )
-            stdio, write = stdio_transport
-            session = await self.exit_stack.enter_async_context(
-                ClientSession(stdio, write)
-            )
-            
-            await session.initialize()
-            
-            # 获取可用工具
-            response = await session.list_tools()
+            # 建立连接并获取可用工具
+            session, stdio, write, server_tools = await self._open_session(server_params)
             tools = [{
                 "name": tool.name,
                 "description": tool.description,
                 "input_schema": tool.inputSchema,
                 "server": server_config.name  # 添加服务器标识
-            } for tool in response.tools]
+            } for tool in server_tools]
+            self._retryable_tools.update(tool.name for tool in server_tools if self._is_retryable_tool(tool))
             
             # 创建服务器连接对象
             connection = ServerConnection(
@@ -171,15 +365,117 @@ class MultiServerMCPClient:
             print(f"连接服务器 {server_config.name} 时出错: {e}")
             raise
 
-    def get_all_tools(self) -> List[Dict[str, Any]]:
-        """获取所有服务器的工具列表"""
+    async def _connect_to_group(self, group_name: str, server_configs: List[ServerConfig]):
+        """在一个进程中启动同组的多个Python服务器，并按各自的逻辑服务器注册"""
+        try:
+            for server_config in server_configs:
+                if not os.path.exists(server_config.script_path):
+                    raise FileNotFoundError(f"服务器脚本不存在: {server_config.script_path}")
+            
+            server_params = StdioServerParameters(
+                command="python",
+                args=[_GROUP_SERVER_SCRIPT, group_name] + [
+                    f"{server_config.name}={os.path.abspath(server_config.script_path)}"
+                    for server_config in server_configs
+                ],
+                env=None
+            )
+            
+            # 建立连接，并把工具按前缀分配给各个逻辑服务器
+            session, stdio, write, server_tools = await self._open_session(server_params)
+            for server_config in server_configs:
+                prefix = f"{server_config.name}{TOOL_NAME_SEPARATOR}"
+                group_tools = [tool for tool in server_tools if tool.name.startswith(prefix)]
+                tools = [{
+                    "name": tool.name[len(prefix):],
+                    "description": tool.description,
+                    "input_schema": tool.inputSchema,
+                    "server": server_config.name  # 添加服务器标识
+                } for tool in group_tools]
+                self._retryable_tools.update(
+                    tool.name[len(prefix):] for tool in group_tools if self._is_retryable_tool(tool)
+                )
+                
+                connection = ServerConnection(
+                    config=server_config,
+                    session=session,
+                    stdio=stdio,
+                    write=write,
+                    tools=tools,
+                    tool_prefix=prefix
+                )
+                
+                # 保存连接和工具映射
+                self.servers[server_config.name] = connection
+                for tool in tools:
+                    self.tool_server_map[tool["name"]] = server_config.name
+                    
+                print(f"服务器 {server_config.name} 提供工具: {[tool['name'] for tool in tools]}")
+            
+        except Exception as e:
+            print(f"连接服务器组 {group_name} 时出错: {e}")
+            raise
+
+    async def _open_session(self, server_params: StdioServerParameters):
+        """启动服务器进程并完成初始化，超时或连接中断时按 retry_attempts 重新启动"""
+        async def open_once():
+            async with AsyncExitStack() as stack:
+                stdio, write = await stack.enter_async_context(stdio_client(server_params))
+                session = await stack.enter_async_context(ClientSession(stdio, write))
+                await session.initialize()
+                response = await session.list_tools()
+                # 连接成功后交由 self.exit_stack 统一关闭；失败时本次启动的进程在此处关闭
+                self.exit_stack.push_async_exit(stack.pop_all())
+                return session, stdio, write, response.tools
+        
+        return await self._with_retry(
+            open_once,
+            self.global_settings.get("connection_timeout", 30),
+            self.global_settings.get("retry_attempts", 1)
+        )
+
+    @staticmethod
+    def _is_retryable_tool(tool) -> bool:
+        """工具通过注解声明为只读或幂等时，重复调用没有副作用"""
+        annotations = tool.annotations
+        return bool(annotations and (annotations.readOnlyHint or annotations.idempotentHint))
+
+    def _refresh_tool_caches(self):
+        """根据已连接的服务器重建工具列表缓存"""
         all_tools = []
         for server_name, connection in self.servers.items():
             all_tools.extend(connection.tools)
-        return all_tools
+        if all_tools:
+            all_tools.append(_BATCH_EXECUTE_TOOL_SPEC)
+        self._all_tools_cached = all_tools
+        
+        # Anthropic 不接受额外的字段，去掉服务器标识
+        self._anthropic_tools_cached = [
+            {k: v for k, v in tool.items() if k != "server"} for tool in all_tools
+        ]
+        
+        self._tool_names = [tool["name"] for tool in all_tools]
+        self._tool_descs = [tool["description"] for tool in all_tools]
+        self._tool_servers = [tool.get("server", "未知") for tool in all_tools]
+        self._tool_schemas = [tool.get("input_schema", {}) for tool in all_tools]
+        self._tool_param_names = [tuple(schema.get("properties") or ()) for schema in self._tool_schemas]
+        self._qwen_tools_prompt = self._build_qwen_tools_prompt()
+
+    def get_all_tools(self) -> List[Dict[str, Any]]:
+        """获取所有服务器的工具列表"""
+        return self._all_tools_cached
+
+    def _tool_server_name(self, tool_name: str) -> str:
+        """返回提供工具的服务器名称，内置工具显示为客户端内置"""
+        if tool_name == BATCH_EXECUTE_TOOL:
+            return _BATCH_EXECUTE_TOOL_SPEC["server"]
+        return self.tool_server_map.get(tool_name, "未知")
 
     async def call_tool(self, tool_name: str, tool_args: Dict[str, Any]):
         """调用指定的工具"""
+        if tool_name == BATCH_EXECUTE_TOOL:
+            return await self._batch_execute(tool_args)
+        
         server_name = self.tool_server_map.get(tool_name)
         if not server_name:
             raise ValueError(f"未找到工具 {tool_name} 对应的服务器")
@@ -188,10 +484,126 @@ class MultiServerMCPClient:
         if not server_connection:
             raise ValueError(f"服务器 {server_name} 未连接")
             
-        return await server_connection.session.call_tool(tool_name, tool_args)
+        # 超时的调用可能已在服务器端执行，只有只读或幂等的工具才重试
+        return await self._with_retry(
+            lambda: server_connection.session.call_tool(server_connection.tool_prefix + tool_name, tool_args),
+            self.global_settings.get("tool_call_timeout", 30),
+            self.global_settings.get("retry_attempts", 1) if tool_name in self._retryable_tools else 0
+        )
+
+    async def _with_retry(self, make_call: Callable[[], Awaitable], timeout: float, retry_attempts: int):
+        """为调用加上超时，并在传输层错误时按指数退避最多重试 retry_attempts 次"""
+        for attempt in range(retry_attempts + 1):
+            try:
+                return await asyncio.wait_for(make_call(), timeout=timeout)
+            except Exception as e:
+                if attempt == retry_attempts or not _is_transient_error(e):
+                    raise
+                await asyncio.sleep(0.1 * 2 ** attempt)
 
-    def _call_model(self, messages: list, tools: list = None):
-        """使用配置的模型调用"""
+    async def _batch_execute(self, tool_args: Dict[str, Any], attempts: Optional[Counter] = None) -> CallToolResult:
+        """并行执行 batch_execute 中的各个工具调用，并将结果合并为一个JSON结果"""
+        calls = tool_args.get("calls", [])
+        stop_on_error = tool_args.get("stopOnError", False)
+        max_concurrent = tool_args.get("maxConcurrent", 8)
+        if not isinstance(max_concurrent, int) or isinstance(max_concurrent, bool):
+            raise ValueError(f"maxConcurrent 必须是整数: {max_concurrent!r}")
+        semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        
+        async def run_call(call: Dict[str, Any]):
+            if call.get("tool") == BATCH_EXECUTE_TOOL:
+                raise ValueError("batch_execute 不能嵌套调用")
+            async with semaphore:
+                if attempts is not None:
+                    return await self._call_tool_guarded(call.get("tool"), call.get("args", {}), attempts)
+                return await self.call_tool(call.get("tool"), call.get("args", {}))
+        
+        tasks = [asyncio.create_task(run_call(call)) for call in calls]
+        task_index = {task: i for i, task in enumerate(tasks)}
+        results: List[Any] = [None] * len(tasks)  # None 表示因批次中止而未执行
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                failed = False
+                for task in done:
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        result = e
+                    results[task_index[task]] = result
+                    # MCP工具的错误以 isError 结果返回，而不是抛出异常
+                    failed = failed or isinstance(result, Exception) or bool(result.isError)
+                if stop_on_error and failed:
+                    break
+        finally:
+            # 中止时取消尚未完成的调用，保留已完成的结果
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        batch_results = []
+        has_error = False
+        for call, result in zip(calls, results):
+            if result is None:
+                has_error = True
+                batch_results.append({"tool": call.get("tool"), "skipped": True})
+            elif isinstance(result, Exception):
+                has_error = True
+                batch_results.append({"tool": call.get("tool"), "error": str(result)})
+            else:
+                has_error = has_error or bool(result.isError)
+                batch_results.append({"tool": call.get("tool"), "result": _result_text(result), "isError": bool(result.isError)})
+        
+        return CallToolResult(
+            content=[TextContent(type="text", text=json.dumps(batch_results, ensure_ascii=False))],
+            isError=has_error
+        )
+
+    async def _call_tool_guarded(self, tool_name: str, tool_args: Dict[str, Any], attempts: Counter):
+        """调用工具，相同的工具和参数在一次查询中重复过多时中止，防止循环调用"""
+        key = (tool_name, hashlib.blake2b(_canonical_json(tool_args), digest_size=8).hexdigest())
+        if attempts[key] >= _MAX_TOOL_CALL_REPEATS:
+            raise RuntimeError("[已中止以防止循环调用]")
+        attempts[key] += 1
+        if tool_name == BATCH_EXECUTE_TOOL:
+            return await self._batch_execute(tool_args, attempts)
+        return await self.call_tool(tool_name, tool_args)
+
+    def _over_token_budget(self, messages: list) -> bool:
+        """粗略估算对话的token数（约4个字符一个token），判断是否超过 max_tokens_budget"""
+        budget = self.global_settings.get("max_tokens_budget")
+        if not budget:
+            return False
+        return sum(len(str(msg["content"])) for msg in messages) // 4 > budget
+
+    def _build_qwen_tools_prompt(self) -> str:
+        """根据缓存的工具信息生成添加到Qwen对话开头的工具说明"""
+        tools_info = "可用工具:\n" + "\n".join(
+            f"- {name} (来自服务器: {server}): {desc}" + (f" (参数: {', '.join(params)})" if params else "")
+            for name, server, desc, params in zip(
+                self._tool_names, self._tool_servers, self._tool_descs, self._tool_param_names
+            )
+        )
+        tools_info += "\n\n要使用工具，请回复: TOOL_CALL: 工具名称 {\"参数1\": \"值1\", \"参数2\": \"值2\"}"
+        return tools_info
+
+    async def _call_model(self, messages: list, tools: list = None,
+                          on_text: Optional[Callable[[str], None]] = None,
+                          on_tool_use: Optional[Callable[[Any], None]] = None):
+        """使用配置的模型调用，传入 on_text 时以流式方式逐段输出文本"""
+        timeout = self.global_settings.get("model_timeout", 120)
+        make_call = lambda: self._request_model(messages, tools, on_text, on_tool_use)
+        if on_text or on_tool_use:
+            # 已经输出的内容无法撤回，流式调用只限时不重试
+            return await asyncio.wait_for(make_call(), timeout=timeout)
+        return await self._with_retry(make_call, timeout, self.global_settings.get("retry_attempts", 1))
+
+    async def _request_model(self, messages: list, tools: list = None,
+                             on_text: Optional[Callable[[str], None]] = None,
+                             on_tool_use: Optional[Callable[[Any], None]] = None):
+        """向模型发送一次请求"""
         model_name = self.model_config.get("model")
         max_tokens = self.model_config.get("max_tokens", 1000)
         
@@ -203,7 +615,16 @@ class MultiServerMCPClient:
             }
             if tools:
                 kwargs["tools"] = tools
-            return self.anthropic.messages.create(**kwargs)
+            # 流式接收，每个 tool_use 块完成时立即回调，无需等待整条消息结束
+            async with self.anthropic.messages.stream(**kwargs) as stream:
+                async for event in stream:
+                    if event.type == "text":
+                        if on_text:
+                            on_text(event.text)
+                    elif event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                        if on_tool_use:
+                            on_tool_use(event.content_block)
+                return await stream.get_final_message()
             
         elif self.client_type == "qwen":
             # 转换消息格式为Qwen格式
@@ -223,16 +644,9 @@ class MultiServerMCPClient:
             
             # 如果有工具，添加工具信息到系统消息
             if tools:
-                tool_descriptions = []
-                for tool in tools:
-                    tool_desc = f"- {tool['name']} (来自服务器: {tool.get('server', '未知')}): {tool['description']}"
-                    if tool.get('input_schema', {}).get('properties'):
-                        params = list(tool['input_schema']['properties'].keys())
-                        tool_desc += f" (参数: {', '.join(params)})"
-                    tool_descriptions.append(tool_desc)
-                
-                tools_info = "可用工具:\n" + "\n".join(tool_descriptions)
-                tools_info += "\n\n要使用工具，请回复: TOOL_CALL: 工具名称 {\"参数1\": \"值1\", \"参数2\": \"值2\"}"
+                tools_info = self._qwen_tools_prompt
+                if tools_info is None:
+                    tools_info = self._build_qwen_tools_prompt()
                 
                 # 将工具信息添加到第一个用户消息
                 if qwen_messages and qwen_messages[0]["role"] == "user":
@@ -240,16 +654,42 @@ class MultiServerMCPClient:
                 else:
                     qwen_messages.insert(0, {"role": "user", "content": tools_info})
             
-            response = Generation.call(
+            # DashScope 的 SDK 没有异步接口，在线程中执行阻塞调用
+            if on_text is None:
+                return await asyncio.to_thread(
+                    Generation.call,
+                    model=model_name,
+                    messages=qwen_messages,
+                    max_tokens=max_tokens,
+                    result_format='message'
+                )
+
+            # 增量流式调用：每个分块只包含新增的内容，结束后拼接为完整回复
+            chunks = await asyncio.to_thread(
+                Generation.call,
                 model=model_name,
                 messages=qwen_messages,
                 max_tokens=max_tokens,
-                result_format='message'
+                result_format='message',
+                stream=True,
+                incremental_output=True
             )
+            response = None
+            parts = []
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                response = chunk
+                if chunk.status_code != 200:
+                    return response
+                delta = chunk.output.choices[0].message.content
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+            if response is not None:
+                response.output.choices[0].message.content = "".join(parts)
             return response
 
-    async def process_query(self, query: str) -> str:
-        """处理查询请求"""
+    async def process_query(self, query: str, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """处理查询请求，模型可多轮调用工具；传入 on_text 时模型回复与工具调用信息会边生成边输出"""
         messages = [
             {
                 "role": "user",
@@ -258,99 +698,170 @@ class MultiServerMCPClient:
         ]
 
         # 获取所有可用工具
-        available_tools = self.get_all_tools()
-
-        # 调用模型
-        response = self._call_model(messages, available_tools)
+        if self.client_type == "anthropic":
+            available_tools = self._anthropic_tools_cached
+        else:
+            available_tools = self.get_all_tools()
 
         # 处理响应和工具调用
         tool_results = []
         final_text = []
+        attempts: Counter = Counter()  # (工具名, 参数哈希) -> 本次查询中的调用次数
+        max_rounds = self.global_settings.get("max_tool_rounds", _MAX_TOOL_ROUNDS)
+        consecutive_errors = 0
 
-        if self.client_type == "anthropic":
-            for content in response.content:
-                if content.type == 'text':
-                    final_text.append(content.text)
-                elif content.type == 'tool_use':
-                    tool_name = content.name
-                    tool_args = content.input
-                    
-                    # 执行工具调用
-                    try:
-                        result = await self.call_tool(tool_name, tool_args)
-                        server_name = self.tool_server_map.get(tool_name, "未知")
-                        tool_results.append({"call": tool_name, "result": result, "server": server_name})
-                        final_text.append(f"[调用服务器 {server_name} 的工具 {tool_name}，参数: {tool_args}]")
-
-                        # 继续对话
-                        if hasattr(content, 'text') and content.text:
-                            messages.append({
-                              "role": "assistant",
-                              "content": content.text
-                            })
-                        messages.append({
-                            "role": "user", 
-                            "content": result.content
+        def emit(line: str):
+            """记录一行非流式输出，并在流式模式下立即输出"""
+            final_text.append(line)
+            if on_text:
+                on_text(line + "\n")
+
+        def record_result(tool_name: str, tool_args: Any, result: Any) -> bool:
+            """输出一次工具调用的结果，返回该调用是否失败"""
+            nonlocal consecutive_errors
+            if isinstance(result, Exception):
+                emit(f"工具调用失败: {result}")
+                consecutive_errors += 1
+                return True
+            server_name = self._tool_server_name(tool_name)
+            tool_results.append({"call": tool_name, "result": result, "server": server_name})
+            emit(f"[调用服务器 {server_name} 的工具 {tool_name}，参数: {tool_args}]")
+            consecutive_errors = consecutive_errors + 1 if result.isError else 0
+            return False
+
+        for round_index in range(max_rounds + 1):
+            # 最后一轮只允许模型作答，不再执行工具
+            last_round = round_index == max_rounds
+            
+            if self.client_type == "anthropic":
+                # tool_use 块一结束就开始执行工具，与模型剩余输出重叠
+                tool_tasks = {}
+
+                def start_tool(block):
+                    tool_tasks[block.id] = asyncio.create_task(
+                        self._call_tool_guarded(block.name, block.input, attempts)
+                    )
+
+                try:
+                    response = await self._call_model(
+                        messages, available_tools, on_text=on_text,
+                        on_tool_use=None if last_round else start_tool
+                    )
+                except BaseException:
+                    for task in tool_tasks.values():
+                        task.cancel()
+                    raise
+                text = "".join(content.text for content in response.content if content.type == 'text')
+                if text:
+                    final_text.append(text)
+                    if on_text:
+                        on_text("\n")
+                tool_uses = [content for content in response.content if content.type == 'tool_use']
+                if not tool_uses:
+                    break
+                if last_round:
+                    emit(f"已达到最大工具调用轮数 ({max_rounds})，停止继续调用工具")
+                    break
+
+                # 等待所有工具调用完成（已在流式接收期间并发启动）
+                for content in tool_uses:
+                    if content.id not in tool_tasks:
+                        start_tool(content)
+                results = await asyncio.gather(
+                    *(tool_tasks[content.id] for content in tool_uses),
+                    return_exceptions=True
+                )
+
+                tool_result_blocks = []
+                for content, result in zip(tool_uses, results):
+                    if record_result(content.name, content.input, result):
+                        tool_result_blocks.append({
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": f"工具调用失败: {result}",
+                            "is_error": True
+                        })
+                    else:
+                        tool_result_blocks.append({
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": [{"type": "text", "text": item.text} for item in result.content if item.type == "text"],
+                            "is_error": bool(result.isError)
                         })
 
-                        # 获取下一个响应
-                        response = self._call_model(messages, available_tools)
-                        final_text.append(response.content[0].text)
-                        
-                    except Exception as e:
-                        final_text.append(f"工具调用失败: {e}")
-                        
-        elif self.client_type == "qwen":
-            if response.status_code == 200:
+                # 将所有工具结果一次性返回给模型
+                messages.append({
+                    "role": "assistant",
+                    "content": response.content
+                })
+                messages.append({
+                    "role": "user",
+                    "content": tool_result_blocks
+                })
+                            
+            elif self.client_type == "qwen":
+                # 流式输出时隐藏回复中的 TOOL_CALL 指令行
+                line_filter = _ToolCallLineFilter(on_text) if on_text else None
+                response = await self._call_model(
+                    messages, available_tools, on_text=line_filter.feed if line_filter else None
+                )
+                if line_filter:
+                    line_filter.close()
+                if response is None or response.status_code != 200:
+                    emit(f"错误: {response.message if response is not None else '模型没有返回内容'}")
+                    break
                 message_content = response.output.choices[0].message.content
                 
-                # 检查响应是否包含工具调用
-                if "TOOL_CALL:" in message_content:
-                    lines = message_content.split('\n')
-                    for line in lines:
-                        if line.strip().startswith("TOOL_CALL:"):
-                            try:
-                                # 解析工具调用: TOOL_CALL: tool_name {"param": "value"}
-                                parts = line.strip().split("TOOL_CALL:", 1)[1].strip().split(" ", 1)
-                                tool_name = parts[0].strip()
-                                tool_args = {}
-                                
-                                if len(parts) > 1:
-                                    tool_args = json.loads(parts[1].strip())
-                                
-                                # 执行工具调用
-                                result = await self.call_tool(tool_name, tool_args)
-                                server_name = self.tool_server_map.get(tool_name, "未知")
-                                tool_results.append({"call": tool_name, "result": result, "server": server_name})
-                                final_text.append(f"[调用服务器 {server_name} 的工具 {tool_name}，参数: {tool_args}]")
-                                
-                                # 继续对话
-                                messages.append({
-                                    "role": "assistant",
-                                    "content": message_content
-                                })
-                                messages.append({
-                                    "role": "user",
-                                    "content": f"工具结果: {result.content}"
-                                })
-                                
-                                # 获取下一个响应
-                                response = self._call_model(messages, available_tools)
-                                if response.status_code == 200:
-                                    final_text.append(response.output.choices[0].message.content)
-                                
-                            except Exception as e:
-                                final_text.append(f"解析工具调用时出错: {e}")
-                                final_text.append(message_content)
-                            break
+                # 收集响应中的所有工具调用
+                tool_calls = []
+                try:
+                    for match in _TOOL_CALL_RE.finditer(message_content):
+                        tool_args = _json_loads(match.group(2)) if match.group(2) else {}
+                        tool_calls.append((match.group(1), tool_args))
+                except Exception as e:
+                    emit(f"解析工具调用时出错: {e}")
+                    emit(message_content)
+                    break
+                
+                text = _TOOL_CALL_RE.sub("", message_content).strip()
+                if text:
+                    final_text.append(text)
+                if not tool_calls:
+                    break
+                if last_round:
+                    emit(f"已达到最大工具调用轮数 ({max_rounds})，停止继续调用工具")
+                    break
+
+                # 并发执行所有工具调用
+                results = await asyncio.gather(
+                    *(self._call_tool_guarded(tool_name, tool_args, attempts) for tool_name, tool_args in tool_calls),
+                    return_exceptions=True
+                )
+                
+                result_texts = []
+                for (tool_name, tool_args), result in zip(tool_calls, results):
+                    if record_result(tool_name, tool_args, result):
+                        result_texts.append(f"工具结果 [{tool_name}]: 调用失败: {result}")
                     else:
-                        # 没有找到工具调用，直接添加消息
-                        final_text.append(message_content)
-                else:
-                    final_text.append(message_content)
+                        result_texts.append(f"工具结果 [{tool_name}]: {_result_text(result)}")
                 
-            else:
-                final_text.append(f"错误: {response.message}")
+                # 将所有工具结果一次性返回给模型
+                messages.append({
+                    "role": "assistant",
+                    "content": message_content
+                })
+                messages.append({
+                    "role": "user",
+                    "content": "\n\n".join(result_texts)
+                })
+            
+            # 出现连续失败或超出预算时不再把结果交给模型，避免错误循环
+            if consecutive_errors >= _MAX_CONSECUTIVE_TOOL_ERRORS:
+                emit(f"工具调用连续失败 {consecutive_errors} 次，停止继续调用模型")
+                break
+            if self._over_token_budget(messages):
+                emit("对话已超出token预算，停止继续调用模型")
+                break
 
         return "\n".join(final_text)
 
@@ -363,7 +874,7 @@ class MultiServerMCPClient:
         
         while True:
             try:
-                query = input("\n查询: ").strip()
+                query = (await _ainput("\n查询: ")).strip()
                 
                 if query.lower() == 'quit':
                     break
@@ -374,9 +885,11 @@ class MultiServerMCPClient:
                     self._show_tools()
                     continue
                     
-                response = await self.process_query(query)
-                print("\n" + response)
+                print()
+                await self.process_query(query, on_text=lambda text: print(text, end="", flush=True))
                     
+            except EOFError:
+                break
             except Exception as e:
                 print(f"\n错误: {str(e)}")
 
@@ -398,6 +911,9 @@ class MultiServerMCPClient:
     
     async def cleanup(self):
         """清理资源"""
+        # 先关闭模型客户端的连接池，关闭服务器连接时出错也不会跳过这一步
+        if self.client_type == "anthropic":
+            await self.anthropic.close()
         try:
             await self.exit_stack.aclose()
         except Exception as e:
@@ -435,4 +951,10 @@ async def main():
 
 if __name__ == "__main__":
     import sys
+    # uvloop为可选依赖，安装后使用更快的事件循环
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())
@@ -51,14 +51,21 @@ async def test_multi_server():
         "global_settings": {
             "concurrent_connections": 3,
             "connection_timeout": 10,
+            "tool_call_timeout": 30,
+            "model_timeout": 120,
             "retry_attempts": 2
         }
     }
     
     # 保存测试配置
     config_path = "test_config.json"
-    with open(config_path, 'w', encoding='utf-8') as f:
-        json.dump(test_config, f, indent=2, ensure_ascii=False)
+    try:
+        import orjson
+        config_bytes = orjson.dumps(test_config, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    except ImportError:
+        config_bytes = json.dumps(test_config, indent=2, ensure_ascii=False).encode('utf-8')
+    with open(config_path, 'wb') as f:
+        f.write(config_bytes)
     
     print("🧪 开始测试多服务器MCP客户端...")
     
@@ -147,6 +154,13 @@ def main():
         print("请运行: uv sync 或 pip install -r requirements.txt")
         return
     
+    # uvloop为可选依赖，安装后使用更快的事件循环
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    
     # 运行测试
     try:
         result = asyncio.run(test_multi_server())
@@ -1,11 +1,18 @@
 import math
 from typing import Any
 from mcp.server.fastmcp import FastMCP
+from mcp.types import ToolAnnotations
 
 # 初始化FastMCP服务器
 mcp = FastMCP("calculator")
 
-@mcp.tool()
+# 所有工具都是无副作用的纯函数，客户端超时后可以安全重试
+_READ_ONLY = ToolAnnotations(readOnlyHint=True)
+
+# 小整数阶乘的预计算表，覆盖最常见的输入
+_FACTORIAL_TABLE = tuple(math.factorial(i) for i in range(65))
+
+@mcp.tool(annotations=_READ_ONLY)
 def add(a: float, b: float) -> float:
     """两个数相加
     
@@ -18,7 +25,7 @@ def add(a: float, b: float) -> float:
     """
     return a + b
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def subtract(a: float, b: float) -> float:
     """两个数相减
     
@@ -31,7 +38,7 @@ def subtract(a: float, b: float) -> float:
     """
     return a - b
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def multiply(a: float, b: float) -> float:
     """两个数相乘
     
@@ -44,7 +51,7 @@ def multiply(a: float, b: float) -> float:
     """
     return a * b
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def divide(a: float, b: float) -> float:
     """两个数相除
     
@@ -59,7 +66,7 @@ def divide(a: float, b: float) -> float:
         raise ValueError("除数不能为零")
     return a / b
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def power(base: float, exponent: float) -> float:
     """计算幂
     
@@ -72,7 +79,7 @@ def power(base: float, exponent: float) -> float:
     """
     return math.pow(base, exponent)
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def square_root(number: float) -> float:
     """计算平方根
     
@@ -86,7 +93,7 @@ def square_root(number: float) -> float:
         raise ValueError("不能计算负数的平方根")
     return math.sqrt(number)
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def factorial(n: int) -> int:
     """计算阶乘
     
@@ -98,9 +105,11 @@ def factorial(n: int) -> int:
     """
     if n < 0:
         raise ValueError("不能计算负数的阶乘")
+    if n < len(_FACTORIAL_TABLE):
+        return _FACTORIAL_TABLE[n]
     return math.factorial(n)
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def sin(angle: float) -> float:
     """计算正弦值（角度制）
     
@@ -112,7 +121,7 @@ def sin(angle: float) -> float:
     """
     return math.sin(math.radians(angle))
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def cos(angle: float) -> float:
     """计算余弦值（角度制）
     
@@ -124,7 +133,7 @@ def cos(angle: float) -> float:
     """
     return math.cos(math.radians(angle))
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def tan(angle: float) -> float:
     """计算正切值（角度制）
     
@@ -1,11 +1,22 @@
 import re
+from collections import Counter
 from typing import List
 from mcp.server.fastmcp import FastMCP
+from mcp.types import ToolAnnotations
 
 # 初始化FastMCP服务器
 mcp = FastMCP("text_processor")
 
-@mcp.tool()
+# 所有工具都是无副作用的纯函数，客户端超时后可以安全重试
+_READ_ONLY = ToolAnnotations(readOnlyHint=True)
+
+# 预编译的正则表达式
+_EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b')
+_URL_RE = re.compile(r'https?://[-A-Za-z0-9_$@.&+!*(),%/:;?#=~]+')
+_SENTENCE_END_RE = re.compile(r'[.!?]+')
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+@mcp.tool(annotations=_READ_ONLY)
 def count_words(text: str) -> int:
     """统计文本中的单词数量
     
@@ -18,7 +29,7 @@ def count_words(text: str) -> int:
     words = text.split()
     return len(words)
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def count_characters(text: str, include_spaces: bool = True) -> int:
     """统计文本中的字符数量
     
@@ -32,9 +43,9 @@ def count_characters(text: str, include_spaces: bool = True) -> int:
     if include_spaces:
         return len(text)
     else:
-        return len(text.replace(" ", ""))
+        return len(text) - text.count(" ")
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def to_uppercase(text: str) -> str:
     """将文本转换为大写
     
@@ -46,7 +57,7 @@ def to_uppercase(text: str) -> str:
     """
     return text.upper()
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def to_lowercase(text: str) -> str:
     """将文本转换为小写
     
@@ -58,7 +69,7 @@ def to_lowercase(text: str) -> str:
     """
     return text.lower()
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def reverse_text(text: str) -> str:
     """反转文本
     
@@ -70,7 +81,7 @@ def reverse_text(text: str) -> str:
     """
     return text[::-1]
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def remove_duplicates(text: str) -> str:
     """移除文本中的重复单词
     
@@ -80,18 +91,16 @@ def remove_duplicates(text: str) -> str:
     Returns:
         移除重复单词后的文本
     """
-    words = text.split()
-    unique_words = []
-    seen = set()
-    
-    for word in words:
-        if word.lower() not in seen:
-            unique_words.append(word)
-            seen.add(word.lower())
-    
-    return " ".join(unique_words)
+    # 以小写形式为键，保留每个单词第一次出现时的原始形式（字典保持插入顺序）
+    unique_words = {}
+    for word in text.split():
+        key = word.lower()
+        if key not in unique_words:
+            unique_words[key] = word
+    
+    return " ".join(unique_words.values())
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def extract_emails(text: str) -> List[str]:
     """从文本中提取邮箱地址
     
@@ -101,11 +110,10 @@ def extract_emails(text: str) -> List[str]:
     Returns:
         找到的邮箱地址列表
     """
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    emails = re.findall(email_pattern, text)
+    emails = _EMAIL_RE.findall(text)
     return emails
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def extract_urls(text: str) -> List[str]:
     """从文本中提取URL
     
@@ -115,11 +123,10 @@ def extract_urls(text: str) -> List[str]:
     Returns:
         找到的URL列表
     """
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    urls = re.findall(url_pattern, text)
+    urls = _URL_RE.findall(text)
     return urls
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def replace_text(text: str, old: str, new: str) -> str:
     """替换文本中的指定内容
     
@@ -133,7 +140,7 @@ def replace_text(text: str, old: str, new: str) -> str:
     """
     return text.replace(old, new)
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def split_sentences(text: str) -> List[str]:
     """将文本分割为句子
     
@@ -144,12 +151,12 @@ def split_sentences(text: str) -> List[str]:
         句子列表
     """
     # 简单的句子分割，基于句号、问号、感叹号
-    sentences = re.split(r'[.!?]+', text)
+    sentences = _SENTENCE_END_RE.split(text)
     # 移除空字符串并去除首尾空格
     sentences = [s.strip() for s in sentences if s.strip()]
     return sentences
 
-@mcp.tool()
+@mcp.tool(annotations=_READ_ONLY)
 def word_frequency(text: str) -> dict:
     """统计文本中每个单词的出现频率
     
@@ -159,24 +166,11 @@ def word_frequency(text: str) -> dict:
     Returns:
         单词频率字典
     """
-    # 转换为小写并分割单词
-    words = text.lower().split()
-    
-    # 移除标点符号
-    cleaned_words = []
-    for word in words:
-        cleaned_word = re.sub(r'[^\w]', '', word)
-        if cleaned_word:
-            cleaned_words.append(cleaned_word)
-    
-    # 统计频率
-    frequency = {}
-    for word in cleaned_words:
-        frequency[word] = frequency.get(word, 0) + 1
-    
-    # 按频率排序
-    sorted_frequency = dict(sorted(frequency.items(), key=lambda x: x[1], reverse=True))
-    return sorted_frequency
+    # 转换为小写，移除标点符号后分割单词
+    words = _PUNCTUATION_RE.sub('', text.lower()).split()
+    
+    # 统计频率并按频率排序
+    return dict(Counter(words).most_common())
 
 if __name__ == "__main__":
     # 初始化并运行服务器